@@ -20,53 +20,124 @@ SPDX-License-Identifier: GPL-3.0-only
 License-Filename: LICENSE
 """
 
+import collections
 import copy
 import errno
+import fnmatch
+import functools
+import json
+import operator
 import os
 import pathlib
+import re
+import stat
+import sys
+import tempfile
 import yaml
-from collections import OrderedDict, UserDict, Mapping, MutableMapping
+from collections import UserDict
+
+try:
+    from yaml import CSafeLoader as _YamlBaseLoader, CSafeDumper as _YamlBaseDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlBaseLoader, SafeDumper as _YamlBaseDumper
 
 __version__ = "0.0.3"
 __copyright__ = "Copyright (C) 2021-2022 Daniel Rudolf"
 __license__ = "GPL-3.0-only"
 
+_MISSING = object()
+_ROOT = pathlib.PurePath('/')
+_FILE_MERGE_KEYS = frozenset({'contents', 'append'})
 
-class YamlLoader(yaml.SafeLoader):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.add_constructor('tag:yaml.org,2002:map', self.construct_yaml_map.__func__)
-
-    def construct_yaml_map(self, node):
-        self.flatten_mapping(node)
-        return OrderedDict(self.construct_pairs(node))
-
-
-class YamlDumper(yaml.SafeDumper):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
 
-        self.add_representer(ButaneConfigFile, self.represent_ordered_dict.__func__)
-        self.add_representer(ButaneConfig, self.represent_ordered_dict.__func__)
-        self.add_representer(YamlFile, self.represent_ordered_dict.__func__)
-        self.add_representer(OrderedDict, self.represent_ordered_dict.__func__)
+class YamlLoader(_YamlBaseLoader):
+    pass
 
-        self.add_representer(str, self.represent_str.__func__)
 
+class YamlDumper(_YamlBaseDumper):
     def represent_ordered_dict(self, data):
         return self.represent_mapping('tag:yaml.org,2002:map', data.items())
 
     def represent_str(self, data):
         if '\n' in data:
             return self.represent_scalar('tag:yaml.org,2002:str', data, style='|')
-        return super().represent_str(data)
+        return self.represent_scalar('tag:yaml.org,2002:str', data)
+
+
+YamlDumper.add_representer(dict, YamlDumper.represent_ordered_dict)
+YamlDumper.add_multi_representer(UserDict, YamlDumper.represent_ordered_dict)
+
+YamlDumper.add_representer(str, YamlDumper.represent_str)
+
+
+@functools.lru_cache(maxsize=512)
+def _loadYaml(path, contents):
+    try:
+        return yaml.load(contents, Loader=YamlLoader)
+    except yaml.MarkedYAMLError as error:
+        error.context_mark = _renameYamlMark(error.context_mark, path)
+        error.problem_mark = _renameYamlMark(error.problem_mark, path)
+        raise
+
+
+def _renameYamlMark(mark, name):
+    if mark is None:
+        return None
+
+    return yaml.Mark(name, mark.index, mark.line, mark.column, mark.buffer, mark.pointer)
+
+
+def _clone(data):
+    if type(data) is dict:
+        return {key: _clone(value) for key, value in data.items()}
+    if type(data) is list:
+        return [_clone(value) for value in data]
+    return data
+
+
+def _freeze(data):
+    if type(data) is dict:
+        return frozenset((key, _freeze(value)) for key, value in data.items())
+    if type(data) is list:
+        return tuple(_freeze(value) for value in data)
+    if type(data) is set:
+        return frozenset(data)
+    return data
+
+
+def _compilePathPatterns(patterns):
+    pathPatterns = [_compilePathPattern(pattern) for pattern in patterns]
+
+    def matchPath(path):
+        pathParts = ['/'] + path[1:].split('/') if path != '/' else ['/']
+        return any(_matchPathPattern(pathPattern, pathParts) for pathPattern in pathPatterns)
+
+    return matchPath
+
+
+def _compilePathPattern(pattern):
+    pattern = pathlib.PurePosixPath(pattern)
+    if not pattern.parts:
+        raise ValueError("Invalid path pattern {!r}: Empty pattern".format(str(pattern)))
+
+    partRegexes = [re.compile(fnmatch.translate(part)) for part in reversed(pattern.parts)]
+    return pattern.is_absolute(), partRegexes
+
+
+def _matchPathPattern(pathPattern, pathParts):
+    isAbsolute, partRegexes = pathPattern
+    if isAbsolute and len(pathParts) != len(partRegexes):
+        return False
+    if len(pathParts) < len(partRegexes):
+        return False
+
+    return all(partRegex.match(pathPart) for partRegex, pathPart in zip(partRegexes, reversed(pathParts)))
 
 
 class YamlFile(UserDict):
     _path = None
 
-    _io = None
+    _contents = None
     _data = None
 
     def __init__(self, path):
@@ -95,11 +166,11 @@ class YamlFile(UserDict):
         return self.dump()
 
     @property
-    def _file(self):
-        if self._io is None:
+    def _fileContents(self):
+        if self._contents is None:
             self.open()
 
-        return self._io
+        return self._contents
 
     def __str__(self):
         return self.path
@@ -113,25 +184,19 @@ class YamlFile(UserDict):
     def open(self):
         self.close()
 
-        try:
-            self._io = self._path.open('r')
-        except:
-            self.close()
-            raise
+        self._contents = self._path.read_bytes()
 
     def close(self):
-        if self._io is not None:
-            self._io.close()
-
-        self._io = None
+        self._contents = None
         self._data = None
 
     def load(self):
-        self._data = yaml.load(self._file, Loader=YamlLoader)
+        self._data = copy.deepcopy(_loadYaml(self.path, self._fileContents))
         return self._data
 
     def dump(self, **options):
         options['default_flow_style'] = bool(options.get('default_flow_style', False))
+        options['width'] = options.get('width', 2147483647)
         return yaml.dump(self.data, Dumper=YamlDumper, **options)
 
 
@@ -144,6 +209,10 @@ class ButaneConfigFile(YamlFile):
         if storageBasePath:
             self._storage = ButaneStorageConfig(pathlib.Path(storageBasePath))
 
+    @property
+    def storage(self):
+        return self._storage
+
     def open(self):
         super().open()
 
@@ -169,44 +238,55 @@ class ButaneConfigFile(YamlFile):
         self.__updateRecursively(self.data, other if other is not None else kwargs)
 
     def __updateRecursively(self, data, other):
-        if isinstance(data, MutableMapping) and isinstance(other, Mapping):
-            for key, value in other.items():
-                if key in data and (isinstance(value, Mapping) or isinstance(value, list)):
-                    self.__updateRecursively(data[key], value)
-                else:
-                    data[key] = value
-        elif isinstance(data, list) and isinstance(other, list):
-            data.extend(other)
-        else:
-            raise ValueError()
+        stack = [(data, other)]
+        while stack:
+            data, other = stack.pop()
+
+            if type(data) is dict and type(other) is dict:
+                for key, value in other.items():
+                    knownValue = data.get(key, _MISSING)
+                    if knownValue is _MISSING or (type(value) is not dict and type(value) is not list):
+                        data[key] = value
+                    else:
+                        stack.append((knownValue, value))
+            elif type(data) is list and type(other) is list:
+                data.extend(other)
+            else:
+                raise ValueError()
 
 
 class ButaneConfig(ButaneConfigFile):
     _mergeConfigs = None
+    _cachePath = None
 
-    def __init__(self):
+    def __init__(self, cachePath=None):
         super().__init__(
             'config.bu',
             'src/main' if os.path.exists('src/main') else None
         )
 
+        self._cachePath = cachePath
+
     def open(self):
         super().open()
 
         self._mergeConfigs = []
 
-        mergeFilePaths = pathlib.Path('config.bu.d').glob('*.bu')
-        mergeFilePaths = sorted(mergeFilePaths, key=lambda mergeFilePath: str(mergeFilePath))
+        mergeFileEntries = []
+        if os.path.isdir('config.bu.d'):
+            with os.scandir('config.bu.d') as entries:
+                mergeFileEntries = [entry for entry in entries if entry.name.endswith('.bu') and entry.is_file()]
 
-        for mergeFilePath in mergeFilePaths:
-            mergeStoragePath = pathlib.Path('src/').joinpath(mergeFilePath.stem)
+        mergeFileEntries.sort(key=operator.attrgetter('name'))
+
+        for mergeFileEntry in mergeFileEntries:
+            mergeStoragePath = pathlib.Path('src/').joinpath(os.path.splitext(mergeFileEntry.name)[0])
             mergeConfig = ButaneConfigFile(
-                mergeFilePath,
+                mergeFileEntry.path,
                 mergeStoragePath if mergeStoragePath.exists() else None
             )
 
             self._mergeConfigs.append(mergeConfig)
-            mergeConfig.open()
 
     def close(self):
         super().close()
@@ -218,6 +298,17 @@ class ButaneConfig(ButaneConfigFile):
         self._mergeConfigs = None
 
     def load(self):
+        cacheManifest = None
+        if self._cachePath is not None:
+            if self._mergeConfigs is None:
+                self.open()
+
+            cacheManifest = self._getCacheManifest()
+            cacheData = self._loadCache(cacheManifest) if cacheManifest is not None else None
+            if cacheData is not None:
+                self._data = cacheData
+                return self._data
+
         super().load()
 
         for mergeConfig in self._mergeConfigs:
@@ -227,51 +318,121 @@ class ButaneConfig(ButaneConfigFile):
         self._data['storage']['files'] = self._uniqueFiles(self._data['storage']['files'])
         self._data['storage']['links'] = self._uniquePaths(self._data['storage']['links'])
 
+        if cacheManifest is not None:
+            self._dumpCache(cacheManifest)
+
         return self._data
 
+    def _getCacheManifest(self):
+        manifest = []
+
+        paths = collections.deque([('config.bu.d', True, None), ('src', True, None)])
+        for config in [self] + self._mergeConfigs:
+            paths.append((config.path, True, None))
+            if config.storage is not None:
+                paths.append((config.storage.basePath, True, config.storage.configFileName))
+
+        try:
+            while paths:
+                path, followSymlinks, configFileName = paths.popleft()
+
+                try:
+                    pathStat = os.stat(path, follow_symlinks=followSymlinks)
+                except FileNotFoundError:
+                    manifest.append([path])
+                    continue
+
+                manifest.append([path, pathStat.st_mtime_ns, pathStat.st_size, pathStat.st_mode])
+
+                if configFileName is not None and stat.S_ISDIR(pathStat.st_mode):
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            paths.append((entry.path, entry.name == configFileName, configFileName))
+        except OSError:
+            return None
+
+        return sorted(manifest, key=operator.itemgetter(0))
+
+    def _loadCache(self, manifest):
+        try:
+            with open(self._cachePath, 'r') as cacheFile:
+                cache = json.load(cacheFile)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(cache, dict) or not isinstance(cache.get('data'), dict):
+            return None
+        if cache.get('version') != __version__ or cache.get('manifest') != manifest:
+            return None
+
+        return cache['data']
+
+    def _dumpCache(self, manifest):
+        try:
+            cacheJson = json.dumps({'version': __version__, 'manifest': manifest, 'data': self._data})
+        except (TypeError, ValueError):
+            return
+
+        if json.loads(cacheJson)['data'] != self._data:
+            return
+
+        cachePath = pathlib.Path(self._cachePath)
+        cacheTempPath = None
+        try:
+            cacheFd, cacheTempPath = tempfile.mkstemp(prefix=cachePath.name + '.', dir=str(cachePath.parent))
+            with os.fdopen(cacheFd, 'w') as cacheFile:
+                cacheFile.write(cacheJson)
+            os.replace(cacheTempPath, str(cachePath))
+        except OSError:
+            if cacheTempPath is not None:
+                try:
+                    os.unlink(cacheTempPath)
+                except OSError:
+                    pass
+
     def _uniquePaths(self, paths):
         knownPaths = {}
-        uniquePaths = []
 
         for path in paths:
-            if path['path'] not in knownPaths:
-                knownPaths[path['path']] = path
-                uniquePaths.append(path)
-            elif path != knownPaths[path['path']]:
+            knownPath = knownPaths.setdefault(path['path'], path)
+            if knownPath is not path and knownPath != path:
                 raise ValueError()
 
-        return uniquePaths
+        return list(knownPaths.values())
 
     def _uniqueFiles(self, paths):
         knownPaths = {}
-        uniquePaths = []
+        knownShapes = {}
 
         for path in paths:
-            if path['path'] not in knownPaths:
-                knownPaths[path['path']] = path
-                uniquePaths.append(path)
-            elif path != knownPaths[path['path']]:
+            knownPath = knownPaths.setdefault(path['path'], path)
+            if knownPath is not path and knownPath != path:
                 if 'contents' in path:
                     raise ValueError("Cannot overwrite already declared file {!r}".format(path['path']))
 
-                appendContents = path.pop('append') if 'append' in path else []
+                appendContents = path.pop('append', [])
 
-                knownPath = {k: v for k, v in knownPaths[path['path']].items() if k not in {'contents', 'append'}}
-                if path != knownPath:
+                knownShape = knownShapes.get(path['path'])
+                if knownShape is None:
+                    knownShape = knownShapes[path['path']] = self._getFileShape(knownPath)
+
+                if self._getFileShape(path) != knownShape:
                     raise ValueError("Unable to merge duplicate file declaration of {!r}".format(path['path']))
 
-                if 'append' not in knownPaths[path['path']]:
-                    knownPaths[path['path']]['append'] = appendContents
-                else:
-                    knownPaths[path['path']]['append'].extend(appendContents)
+                knownPath.setdefault('append', []).extend(appendContents)
+
+        return list(knownPaths.values())
 
-        return uniquePaths
+    def _getFileShape(self, path):
+        return frozenset((k, _freeze(v)) for k, v in path.items() if k not in _FILE_MERGE_KEYS)
 
 
 class ButaneStorageConfig(UserDict):
     _basePath = None
     _configFileName = None
     _ignorePaths = {'/*', '/usr/*', '/var/*'}
+    _ignoreNames = None
+    _ignoreMatcher = None
 
     _storagePaths = None
     _storageConfigs = None
@@ -288,6 +449,9 @@ class ButaneStorageConfig(UserDict):
         self._basePath = basePath
         self._configFileName = configFileName
         self._ignorePaths = self._ignorePaths | ignorePaths | {configFileName}
+        self._ignoreNames = {ignorePath for ignorePath in self._ignorePaths
+                             if not any(char in ignorePath for char in '/*?[')}
+        self._ignoreMatcher = _compilePathPatterns(self._ignorePaths - self._ignoreNames)
 
     @property
     def basePath(self):
@@ -299,7 +463,7 @@ class ButaneStorageConfig(UserDict):
 
     @property
     def paths(self):
-        return [str(path) for path in self._paths]
+        return [path.path for path in self._paths]
 
     @property
     def configs(self):
@@ -315,14 +479,14 @@ class ButaneStorageConfig(UserDict):
     @property
     def _paths(self):
         if self._storagePaths is None:
-            self.open()
+            self._scan()
 
         return self._storagePaths
 
     @property
     def _configs(self):
         if self._storageConfigs is None:
-            self.open()
+            self._scan()
 
         return self._storageConfigs
 
@@ -336,16 +500,34 @@ class ButaneStorageConfig(UserDict):
         return self.close()
 
     def open(self):
-        self._storagePaths = self._basePath.glob('**/*')
-        self._storagePaths = sorted(self._storagePaths, key=lambda storagePath: str(storagePath))
-
-        self._storageConfigs = self._basePath.glob('**/' + self._configFileName)
+        self.close()
 
     def close(self):
         self._storagePaths = None
         self._storageConfigs = None
         self._data = None
 
+    def _scan(self):
+        self._storagePaths = []
+        self._storageConfigs = []
+
+        for entry in self._walk(str(self._basePath)):
+            self._storagePaths.append(entry)
+            if entry.name == self._configFileName:
+                self._storageConfigs.append(pathlib.Path(entry.path))
+
+        self._storagePaths.sort(key=operator.attrgetter('path'))
+
+    def _walk(self, path):
+        paths = collections.deque((path,))
+        while paths:
+            with os.scandir(paths.popleft()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        paths.append(entry.path)
+
+                    yield entry
+
     def load(self):
         self._data = {'directories': [], 'files': [], 'links': []}
 
@@ -355,51 +537,72 @@ class ButaneStorageConfig(UserDict):
         return self._data
 
     def _loadPaths(self):
-        for path in self._paths:
-            virtualPath = pathlib.PurePath('/').joinpath(path.relative_to(self._basePath))
-            if any(virtualPath.match(ignorePath) for ignorePath in self._ignorePaths):
+        basePathLength = len(self.basePath.rstrip('/'))
+
+        for entry in self._paths:
+            if entry.name in self._ignoreNames:
                 continue
 
-            config = OrderedDict()
-            config['path'] = str(virtualPath)
+            virtualPath = sys.intern(entry.path[basePathLength:])
+            if self._ignoreMatcher(virtualPath):
+                continue
+
+            config = {}
+            config['path'] = virtualPath
 
-            if path.is_symlink():
-                config['target'] = os.readlink(str(path))
+            if entry.is_symlink():
+                config['target'] = os.readlink(entry.path)
                 self._data['links'].append(config)
-            elif path.is_file():
-                if path.stat().st_size > 0:
-                    config['contents'] = {'local': str(path)}
-                if os.access(str(path), os.X_OK):
+            elif entry.is_file(follow_symlinks=False):
+                entryStat = entry.stat(follow_symlinks=False)
+                if entryStat.st_size > 0:
+                    config['contents'] = {'local': entry.path}
+                if entryStat.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
                     config['mode'] = '0755'
 
                 self._data['files'].append(config)
-            elif path.is_dir():
+            elif entry.is_dir(follow_symlinks=False):
                 self._data['directories'].append(config)
 
     def _loadConfigs(self):
         for filePath in self._configs:
-            basePath = '/' + str(filePath.relative_to(self._basePath).parent)
+            basePath = str(_ROOT.joinpath(filePath.relative_to(self._basePath).parent))
 
             with YamlFile(filePath) as file:
                 if 'directories' in file.data:
+                    pathTable = self._getPathTable(self._data['directories'], basePath)
                     for pathConfig in file.data['directories']:
-                        self._applyPathConfig(self._data['directories'], pathConfig, basePath)
+                        self._applyPathConfig(pathTable, pathConfig)
                 if 'files' in file.data:
+                    pathTable = self._getPathTable(self._data['files'], basePath)
                     for pathConfig in file.data['files']:
-                        self._applyPathConfig(self._data['files'], pathConfig, basePath)
+                        self._applyPathConfig(pathTable, pathConfig)
                 if 'links' in file.data:
+                    pathTable = self._getPathTable(self._data['links'], basePath)
                     for pathConfig in file.data['links']:
-                        self._applyPathConfig(self._data['links'], pathConfig, basePath)
+                        self._applyPathConfig(pathTable, pathConfig)
 
-    def _applyPathConfig(self, configs, pathConfig, basePath):
-        pathPattern = pathConfig.pop('path')
+    def _getPathTable(self, configs, basePath):
+        basePathPrefix = basePath.rstrip('/') + '/'
+        basePathLength = len(basePathPrefix) - 1
+
+        pathTable = {}
         for config in configs:
-            try:
-                path = pathlib.PurePath(config['path'])
-                path = path.relative_to(basePath)
-            except ValueError:
-                continue
+            if config['path'] == basePath:
+                pathTable['/'] = config
+            elif config['path'].startswith(basePathPrefix):
+                pathTable[config['path'][basePathLength:]] = config
+
+        return pathTable
+
+    def _applyPathConfig(self, pathTable, pathConfig):
+        pathPattern = pathConfig.pop('path')
+        if pathPattern.startswith('/') and not any(char in pathPattern for char in '*?['):
+            config = pathTable.get(str(pathlib.PurePath(pathPattern)))
+            configs = [config] if config is not None else []
+        else:
+            pathMatcher = _compilePathPatterns((pathPattern,))
+            configs = [config for path, config in pathTable.items() if pathMatcher(path)]
 
-            path = pathlib.PurePath('/').joinpath(path)
-            if path.match(pathPattern):
-                config.update(copy.deepcopy(pathConfig))
+        for index, config in enumerate(configs):
+            config.update(_clone(pathConfig) if index > 0 else pathConfig)
@@ -17,6 +17,7 @@ setup(
     author_email="mbutane@daniel-rudolf.de",
     url="https://github.com/PhrozenByte/mbutane",
     license=licenseContents,
+    python_requires=">=3.7",
     py_modules=["mbutane"],
     scripts=["mbutane"]
 )
@@ -0,0 +1,91 @@
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+
+import mbutane
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self._workingDir = os.getcwd()
+        self._tempDir = tempfile.TemporaryDirectory()
+        os.chdir(self._tempDir.name)
+
+        pathlib.Path('config.bu').write_text('variant: fcos\nversion: 1.4.0\n')
+        pathlib.Path('config.bu.d').mkdir()
+        pathlib.Path('config.bu.d/extra.bu').write_text('passwd:\n  users:\n    - name: core\n')
+        pathlib.Path('src/main/etc').mkdir(parents=True)
+        pathlib.Path('src/main/etc/a.conf').write_text('a\n')
+
+    def tearDown(self):
+        os.chdir(self._workingDir)
+        self._tempDir.cleanup()
+
+    def load(self, cachePath='.mbutane-cache.json'):
+        with mbutane.ButaneConfig(cachePath) as butaneConfig:
+            return butaneConfig.data
+
+    def markCache(self):
+        cachePath = pathlib.Path('.mbutane-cache.json')
+        cache = json.loads(cachePath.read_text())
+        cache['data']['cached'] = True
+        cachePath.write_text(json.dumps(cache))
+
+    def getFilePaths(self, data):
+        return [file['path'] for file in data['storage']['files']]
+
+    def testHit(self):
+        data = self.load()
+        self.assertTrue(os.path.exists('.mbutane-cache.json'))
+        self.assertEqual(self.load(), data)
+
+        self.markCache()
+        self.assertTrue(self.load().get('cached'))
+
+    def testStorageFileAdded(self):
+        self.load()
+        self.markCache()
+
+        pathlib.Path('src/main/etc/b.conf').write_text('b\n')
+        data = self.load()
+        self.assertNotIn('cached', data)
+        self.assertIn('/etc/b.conf', self.getFilePaths(data))
+
+    def testStorageFileChmod(self):
+        self.load()
+        self.markCache()
+
+        os.chmod('src/main/etc/a.conf', 0o755)
+        data = self.load()
+        self.assertNotIn('cached', data)
+        self.assertEqual(data['storage']['files'][0]['mode'], '0755')
+
+    def testMergeConfigEdited(self):
+        self.load()
+        self.markCache()
+
+        pathlib.Path('config.bu.d/extra.bu').write_text('passwd:\n  users:\n    - name: other-user\n')
+        data = self.load()
+        self.assertNotIn('cached', data)
+        self.assertEqual(data['passwd']['users'][0]['name'], 'other-user')
+
+    def testNoJsonRoundTrip(self):
+        pathlib.Path('config.bu.d/extra.bu').write_text('1: one\n')
+        self.assertEqual(self.load()[1], 'one')
+        self.assertFalse(os.path.exists('.mbutane-cache.json'))
+
+    def testUnwritableCachePath(self):
+        data = self.load('missing/.mbutane-cache.json')
+        self.assertIn('/etc/a.conf', self.getFilePaths(data))
+        self.assertEqual(sorted(os.listdir('.')), ['config.bu', 'config.bu.d', 'src'])
+
+    def testUnrelatedSymlinkLoop(self):
+        os.symlink('loop', 'src/loop')
+        self.load()
+        self.assertTrue(os.path.exists('.mbutane-cache.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
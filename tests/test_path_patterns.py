@@ -0,0 +1,27 @@
+import pathlib
+import unittest
+import warnings
+
+import mbutane
+
+
+class PathPatternTest(unittest.TestCase):
+    def assertMatchesPurePath(self, pattern, paths):
+        pathMatcher = mbutane._compilePathPatterns((pattern,))
+        for path in paths:
+            with self.subTest(pattern=pattern, path=path):
+                self.assertEqual(pathMatcher(path), pathlib.PurePosixPath(path).match(pattern))
+
+    def testReversedRanges(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for pattern in ('[z-a]*', '/[z-a]', '[a--]', 'x/[z-a]'):
+                self.assertMatchesPurePath(pattern, ('/', '/a', '/z', '/-', '/x/a', '/x/z'))
+
+    def testPathComponents(self):
+        for pattern in ('*', '/*', '/usr/*', 'b', 'a/*', '*/b', '[!a]', '[]]', '[', '?'):
+            self.assertMatchesPurePath(pattern, ('/', '/a', '/b', '/a/b', '/usr/b', '/]', '/[', '/a/b/c'))
+
+
+if __name__ == '__main__':
+    unittest.main()